@@ -37,6 +37,10 @@ DEFAULT_LEARNING_RATE = 1e-3
 parser.add_argument('--learning-rate', type=float, default=DEFAULT_LEARNING_RATE,
                     help='Learning rate to run with')
 
+DEFAULT_NUM_WORKERS = 0
+parser.add_argument('--num-workers', type=int, default=DEFAULT_NUM_WORKERS,
+                    help='How many dataloader worker processes to prepare batches with')
+
 DEFAULT_PATIENCE_EPOCHS = 50
 parser.add_argument('--patience-epochs', type=int, default=DEFAULT_PATIENCE_EPOCHS,
                     help='How many patience epochs (stop after this many epochs with no improvement)')
@@ -96,7 +100,10 @@ def prettify_class_name(cls):
     return name
 
 
-MODEL_NAMES = [prettify_class_name(model_class) for model_class in MODEL_CONFIGURATIONS['default'].keys()]
+MODEL_NAME_BY_CLASS = {model_class: prettify_class_name(model_class)
+                       for model_configuration in MODEL_CONFIGURATIONS.values() for model_class in model_configuration}
+
+MODEL_NAMES = [MODEL_NAME_BY_CLASS[model_class] for model_class in MODEL_CONFIGURATIONS[DEFAULT_MODEL_CONFIG_KEY]]
 parser.add_argument('--model', type=str, action='append', choices=MODEL_NAMES,
                     help='Which model(s) to use (default: all)')
 
@@ -1,4 +1,5 @@
 import copy
+import io
 import itertools
 import os
 import random
@@ -34,6 +35,14 @@ parser.add_argument('--checkpoint-download-folder', type=str, default=DEFAULT_CH
                     help='Where to download checkpoints to')
 
 
+def load_checkpoint_state_dict(checkpoint_path, device):
+    # Reading the file in one go is much faster than having torch.load read it in many small chunks
+    with open(checkpoint_path, 'rb') as checkpoint_file:
+        checkpoint = torch.load(io.BytesIO(checkpoint_file.read()), map_location=device)
+
+    return checkpoint['state_dict']
+
+
 def run_generalization_test_single_setting(args):
     print(' ' * 26 + 'Options')
     var_args = vars(args)
@@ -72,7 +81,7 @@ def run_generalization_test_single_setting(args):
         model_configurations = MODEL_CONFIGURATIONS[args.model_configuration]
 
         for model_class, model_kwargs in model_configurations.items():
-            model_class_name = prettify_class_name(model_class)
+            model_class_name = MODEL_NAME_BY_CLASS[model_class]
             if args.model is not None and len(args.model) > 0 and model_class_name not in args.model:
                 print(f'Skipping model {model_class_name} because it is not in {args.model}')
                 continue
@@ -85,6 +94,7 @@ def run_generalization_test_single_setting(args):
             model_kwargs['train_epoch_size'] = args.dataset_size
             model_kwargs['validation_epoch_size'] = args.validation_size
             model_kwargs['regenerate_every_epoch'] = False
+            model_kwargs['num_workers'] = args.num_workers
             model_kwargs['train_dataset'] = train_dataset
             model_kwargs['validation_dataset'] = validation_dataset
             model_kwargs['test_dataset'] = test_dataset
@@ -120,12 +130,21 @@ def run_generalization_test_single_setting(args):
             else:
                  checkpoint_file = checkpoint_files[0]
 
-            os.makedirs(args.checkpoint_download_folder, exist_ok=True)
-            checkpoint_file.download(replace=True, root=args.checkpoint_download_folder)
-            checkpoint_path = os.path.join(args.checkpoint_download_folder, checkpoint_file.name)
+            # The same trained model is tested against each other test value, so only download it once
+            run_checkpoint_folder = os.path.join(args.checkpoint_download_folder, original_run.id)
+            checkpoint_path = os.path.join(run_checkpoint_folder, checkpoint_file.name)
+            if not os.path.exists(checkpoint_path):
+                os.makedirs(run_checkpoint_folder, exist_ok=True)
+                checkpoint_file.download(replace=True, root=run_checkpoint_folder)
 
-            model = model_class.load_from_checkpoint(checkpoint_path, **model_kwargs)
             args.use_gpu = int(torch.cuda.is_available())
+            device = torch.device('cuda' if args.use_gpu else 'cpu')
+
+            # Create the model on the device it will be tested on, and load the weights directly onto that device
+            model = model_class(**model_kwargs).to(device)
+            model.load_state_dict(load_checkpoint_state_dict(checkpoint_path, device))
+            # Only ever evaluated here, so no need to track gradients or keep training-mode behavior (e.g. dropout)
+            model.freeze()
 
             logger = WandbLogger(args.wandb_run_name, args.wandb_dir, project=args.wandb_project,
                                  entity=args.wandb_entity, id=original_run.id, version=original_run.id)
@@ -42,7 +42,7 @@ def run_single_setting_all_models(args):
     model_configurations = MODEL_CONFIGURATIONS[args.model_configuration]
 
     for model_class, model_kwargs in model_configurations.items():
-        model_class_name = prettify_class_name(model_class)
+        model_class_name = MODEL_NAME_BY_CLASS[model_class]
         if args.model is not None and len(args.model) > 0 and model_class_name not in args.model:
             print(f'Skipping model {model_class_name} because it is not in {args.model}')
             continue
@@ -55,6 +55,7 @@ def run_single_setting_all_models(args):
         model_kwargs['train_epoch_size'] = args.dataset_size
         model_kwargs['validation_epoch_size'] = args.validation_size
         model_kwargs['regenerate_every_epoch'] = False
+        model_kwargs['num_workers'] = args.num_workers
         model_kwargs['train_dataset'] = train_dataset
         model_kwargs['validation_dataset'] = validation_dataset
 
@@ -5,9 +5,31 @@ class Field:
     def __init__(self, n):
         self.n = n
 
-    def __call__(self):
+    def __call__(self, batch_size=None):
+        """
+        Generate values for this field
+        :param batch_size: How many sets of objects to generate values for. If None, generates a single set.
+        :return: A tensor of shape (n, len(self)) if batch_size is None, or (batch_size, n, len(self)) otherwise
+        """
+        size = (self.n, len(self)) if batch_size is None else (batch_size, self.n, len(self))
+        return self.fill_(torch.empty(size, dtype=self.dtype))
+
+    def fill_(self, out):
+        """
+        Generate values for this field in place, which allows writing directly into a slice of a larger object tensor
+        :param out: A tensor (or view) of shape (..., n, len(self)) to write the values into
+        :return: out
+        """
         raise NotImplemented()
 
+    def can_fuse(self, other):
+        """
+        Whether this field and another one can be filled with a single call to fill_ over both their slices
+        :param other: Another field, which directly follows this one in the object
+        :return: True if other draws its values from the same distribution as this field
+        """
+        return False
+
     def __len__(self):
         return 1
 
@@ -18,14 +40,18 @@ class PositionField(Field):
         self.min_coord = min_coord
         self.max_coord = max_coord
 
+    def can_fuse(self, other):
+        return type(other) is type(self) and other.min_coord == self.min_coord and \
+            other.max_coord == self.max_coord and other.dtype == self.dtype
+
 
 class IntPositionField(PositionField):
     def __init__(self, n, min_coord=0, max_coord=10, dtype=torch.int):
         super(IntPositionField, self).__init__(n, min_coord, max_coord)
         self.dtype = dtype
 
-    def __call__(self):
-        return torch.randint(self.min_coord, self.max_coord, size=(self.n, 1), dtype=self.dtype, requires_grad=False)
+    def fill_(self, out):
+        return out.random_(self.min_coord, self.max_coord)
 
 
 class FloatPositionField(PositionField):
@@ -34,8 +60,8 @@ class FloatPositionField(PositionField):
         self.range = max_coord - min_coord
         self.dtype = dtype
 
-    def __call__(self):
-        return (torch.rand(size=(self.n, 1), dtype=self.dtype, requires_grad=False) * self.range) + self.min_coord
+    def fill_(self, out):
+        return out.uniform_(self.min_coord, self.max_coord)
 
 
 # TODO: Do I create a position as a composite of two (or more) position fields, making sure there's no exact overlap?
@@ -54,18 +80,29 @@ class OneHotField(Field):
             assert(len(self.num_per_type) == self.n_types)
             assert(sum(self.num_per_type) == n)
 
-    def __call__(self):
+            nested_list = [[t] * n for t, n in zip(range(self.n_types), self.num_per_type)]
+            flattened_list = [item for sub_list in nested_list for item in sub_list]
+            self.types_per_object = torch.tensor(flattened_list, dtype=torch.long)
+
+    def can_fuse(self, other):
+        return type(other) is type(self) and other.n_types == self.n_types and other.dtype == self.dtype and \
+            self.num_per_type is None and other.num_per_type is None
+
+    def fill_(self, out):
+        if out.shape[-1] > self.n_types:
+            # A slice spanning several fused fields, fill it as (..., n, k, n_types)
+            self.fill_(out.view(*out.shape[:-1], -1, self.n_types))
+            return out
+
+        types_size = out.shape[:-1]
         if self.num_per_type is None:
-            return self._to_one_hot(torch.randint(self.n_types, size=(self.n,), dtype=self.dtype, requires_grad=False))
+            types = torch.randint(self.n_types, size=types_size, dtype=torch.long, requires_grad=False)
 
-        nested_list = [[t] * n for t, n in zip(range(self.n_types), self.num_per_type)]
-        flattened_list = [item for sub_list in nested_list for item in sub_list]
-        return self._to_one_hot(torch.tensor(flattened_list)[torch.randperm(self.n)])
+        else:
+            # sorting uniform noise gives an independent random permutation for each set of objects
+            types = self.types_per_object[torch.rand(types_size).argsort(dim=-1)]
 
-    def _to_one_hot(self, types):
-        one_hot = torch.zeros(self.n, self.n_types, dtype=self.dtype)
-        one_hot[torch.arange(self.n, dtype=torch.long), types.to(torch.long)] = 1
-        return one_hot
+        return out.zero_().scatter_(-1, types.unsqueeze(-1), 1)
 
     def __len__(self):
         return self.n_types
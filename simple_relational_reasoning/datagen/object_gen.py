@@ -1,8 +1,11 @@
 from collections import namedtuple
+import functools
+import math
 import numpy as np
 import torch
 
 from simple_relational_reasoning.datagen.object_fields import FIELD_TYPES
+from simple_relational_reasoning.datagen.object_relations import any_identical_pair
 
 
 FieldConfig = namedtuple('FieldConfig', ('name', 'type', 'kwargs'))
@@ -14,21 +17,14 @@ DEFAULT_POSITION_FIELDS = ('x', 'y')
 
 def no_position_collision_constraint(object_batch, relevant_indices, field_slices,
                                      position_fields=DEFAULT_POSITION_FIELDS):
-    violating_indices = []
-
     if relevant_indices is None:
-        relevant_indices = range(object_batch.shape[0])
-
-    for idx in relevant_indices:
-        object_positions = torch.cat([object_batch[idx, :, field_slices[pos]] for pos in position_fields],
-                                     dim=1).to(torch.float)
-
-        for obj_idx in range(object_positions.shape[0] - 1):
-            if (object_positions[obj_idx + 1:] == object_positions[obj_idx]).all(dim=1).any():
-                violating_indices.append(idx)
-                break
+        relevant_indices = torch.arange(object_batch.shape[0])
+    else:
+        relevant_indices = torch.as_tensor(relevant_indices, dtype=torch.long)
 
-    return violating_indices
+    object_positions = torch.cat([object_batch[relevant_indices, :, field_slices[pos]] for pos in position_fields],
+                                 dim=-1)
+    return relevant_indices[any_identical_pair(object_positions)].tolist()
 
 
 DEFAULT_CONSTRAINTS = (
@@ -38,7 +34,8 @@ DEFAULT_CONSTRAINTS = (
 
 class ObjectGenerator:
     def __init__(self, n, field_configs, relation_class, constraints=DEFAULT_CONSTRAINTS,
-                 batch_size=1, object_dtype=torch.float, label_dtype=torch.long, relation_kwargs=None):
+                 batch_size=1, object_dtype=torch.float, label_dtype=torch.long, relation_kwargs=None,
+                 pin_memory=False):
         self.n = n
         self.field_configs = field_configs
         assert(all([cfg.type in FIELD_TYPES for cfg in field_configs]))
@@ -54,6 +51,20 @@ class ObjectGenerator:
         slices = [slice(start, end) for start, end in zip(cum_lengths[:-1], cum_lengths[1:])]
         self.field_slices = {name: slices[i] for i, name in enumerate(self.field_generators)}
 
+        # Adjacent fields drawn from the same distribution are filled by a single call over their combined slice
+        self._fill_groups = []
+        for name, gen in self.field_generators.items():
+            field_slice = self.field_slices[name]
+            if len(self._fill_groups) > 0 and self._fill_groups[-1][0].can_fuse(gen):
+                group_gen, group_slice = self._fill_groups[-1]
+                self._fill_groups[-1] = (group_gen, slice(group_slice.start, field_slice.stop))
+            else:
+                self._fill_groups.append((gen, field_slice))
+
+        self.object_size = int(cum_lengths[-1])
+        self._buffer_dtype = functools.reduce(torch.promote_types,
+                                              [gen.dtype for gen in self.field_generators.values()])
+
         if relation_kwargs is None:
             relation_kwargs = {}
 
@@ -66,15 +77,57 @@ class ObjectGenerator:
         if label_dtype is None:
             label_dtype = object_dtype
         self.label_dtype = label_dtype
+        self.pin_memory = pin_memory
+
+        # a scratch buffer for intermediate batches, which are consumed immediately
+        self._scratch = None
+
+    def _allocate(self, batch_size, pin_memory=False, label_dtype=None):
+        if label_dtype is None:
+            label_dtype = self.label_dtype
 
-        self.object_size = self(1)[0].shape[-1]
+        return (torch.empty((batch_size, self.n, self.object_size), dtype=self._buffer_dtype,
+                            pin_memory=pin_memory),
+                torch.empty((batch_size,), dtype=label_dtype, pin_memory=pin_memory))
+
+    def _scratch_buffer(self, batch_size):
+        if self._scratch is None or self._scratch[0].shape[0] < batch_size:
+            # intermediate labels are only ever compared and counted, so they are kept as booleans
+            self._scratch = self._allocate(batch_size, label_dtype=torch.bool)
+
+        batch_buffer, label_buffer = self._scratch
+        return batch_buffer[:batch_size], label_buffer[:batch_size]
+
+    def _generate_objects(self, batch_size, out=None):
+        if out is None:
+            out = self._allocate(batch_size)[0]
+
+        for gen, group_slice in self._fill_groups:
+            gen.fill_(out[:, :, group_slice])
+
+        return out
+
+    def _evaluate_relation(self, batch_tensor, out=None):
+        batch_labels = self.relation.evaluate_batch(batch_tensor)
+
+        if out is None:
+            return batch_labels.to(self.label_dtype)
+
+        return out.copy_(batch_labels)
 
     def __call__(self, batch_size=None):
+        """
+        Generate a batch of sets of objects and their labels
+        :param batch_size: How many sets of objects to generate, defaulting to the generator's batch size
+        :return: A tensor of shape (B, N, F) of sets of objects, and a tensor of shape (B,) of their labels
+        """
         if batch_size is None:
             batch_size = self.batch_size
 
-        batch_tensor = torch.stack([torch.cat([gen() for gen in self.field_generators.values()], dim=1)
-                                    for _ in range(batch_size)])
+        return self._generate(batch_size, *self._allocate(batch_size, self.pin_memory))
+
+    def _generate(self, batch_size, out=None, label_out=None):
+        batch_tensor = self._generate_objects(batch_size, out)
 
         if self.constraints is not None:
             any_violations = True
@@ -94,22 +147,47 @@ class ObjectGenerator:
                 else:
 
                     violating_indices = sorted(violating_indices)
-                    new_elements = torch.stack([torch.cat([gen() for gen in self.field_generators.values()], dim=1)
-                                    for _ in range(n_violations)])
-                    batch_tensor[violating_indices] = new_elements
+                    batch_tensor[violating_indices] = self._generate_objects(n_violations)
                     prev_violating_indices = violating_indices
 
-        batch_labels = torch.tensor([self.relation.evaluate(batch_tensor[i])
-                                     for i in range(batch_size)], dtype=self.label_dtype)
-        return batch_tensor, batch_labels
+        return batch_tensor, self._evaluate_relation(batch_tensor, label_out)
 
 
 class BalancedBatchObjectGenerator(ObjectGenerator):
     def __init__(self, n, field_configs, relation_class, batch_size=1, constraints=DEFAULT_CONSTRAINTS,
-                 object_dtype=torch.float, label_dtype=torch.long, relation_kwargs=None):
+                 object_dtype=torch.float, label_dtype=torch.long, relation_kwargs=None, pin_memory=False,
+                 oversample_safety_factor=1.25, max_oversample_factor=16, positive_rate_momentum=0.9):
         super(BalancedBatchObjectGenerator, self).__init__(
             n=n, field_configs=field_configs, relation_class=relation_class, constraints=constraints,
-            batch_size=batch_size, object_dtype=object_dtype, label_dtype=label_dtype, relation_kwargs=relation_kwargs)
+            batch_size=batch_size, object_dtype=object_dtype, label_dtype=label_dtype, relation_kwargs=relation_kwargs,
+            pin_memory=pin_memory)
+        self.oversample_safety_factor = oversample_safety_factor
+        self.max_oversample_factor = max_oversample_factor
+        self.positive_rate_momentum = positive_rate_momentum
+        self.positive_rate = None
+
+    def _update_positive_rate(self, labels):
+        batch_positive_rate = float(labels.float().mean())
+        if self.positive_rate is None:
+            self.positive_rate = batch_positive_rate
+        else:
+            self.positive_rate = self.positive_rate_momentum * self.positive_rate + \
+                                 (1 - self.positive_rate_momentum) * batch_positive_rate
+
+    def _oversample_size(self, batch_size, positives_needed, negatives_needed):
+        """
+        Estimate how many examples to draw in order to get the needed number of each class in a single draw,
+        using the running estimate of the positive rate of the relation
+        """
+        if self.positive_rate is None:
+            return batch_size
+
+        max_size = self.max_oversample_factor * batch_size
+        sizes_needed = [needed / rate if rate > 0 else max_size
+                        for needed, rate in ((positives_needed, self.positive_rate),
+                                             (negatives_needed, 1 - self.positive_rate))
+                        if needed > 0]
+        return min(max_size, int(math.ceil(max(sizes_needed) * self.oversample_safety_factor)))
 
     def __call__(self, batch_size=None):
         if batch_size is None:
@@ -119,36 +197,47 @@ class BalancedBatchObjectGenerator(ObjectGenerator):
             return super(BalancedBatchObjectGenerator, self).__call__(1)
 
         half_batch_size = int(batch_size / 2)
-        negative_examples, positive_examples = [], []
+        output_size = 2 * half_batch_size
+        output_data, output_labels = self._allocate(output_size, self.pin_memory)
+
+        # Shuffle the batch by writing the examples of each class directly to random locations in the output
+        perm = torch.randperm(output_size)
+        positive_locations, negative_locations = perm[:half_batch_size], perm[half_batch_size:]
+        output_labels[positive_locations] = 1
+        output_labels[negative_locations] = 0
+
         negative_count, positive_count = 0, 0
+        # Usually a single iteration, only repeating if the oversampled draw was unlucky
         while negative_count < half_batch_size or positive_count < half_batch_size:
-            data, labels = super(BalancedBatchObjectGenerator, self).__call__(batch_size)
-            positive_locations = labels.bool()
-            batch_positive_count = labels.sum()
+            sample_size = self._oversample_size(batch_size, half_batch_size - positive_count,
+                                                half_batch_size - negative_count)
+            data, labels = self._generate(sample_size, *self._scratch_buffer(sample_size))
+            self._update_positive_rate(labels)
+            positive_mask = labels.bool()
 
             if positive_count < half_batch_size:
-                positive_examples.append(data[positive_locations])
-                positive_count += batch_positive_count
+                positive_indices = torch.nonzero(positive_mask).squeeze(1)[:half_batch_size - positive_count]
+                num_positives = positive_indices.shape[0]
+                output_data[positive_locations[positive_count:positive_count + num_positives]] = data[positive_indices]
+                positive_count += num_positives
 
             if negative_count < half_batch_size:
-                negative_examples.append(data[~positive_locations])
-                negative_count += batch_size - batch_positive_count
+                negative_indices = torch.nonzero(~positive_mask).squeeze(1)[:half_batch_size - negative_count]
+                num_negatives = negative_indices.shape[0]
+                output_data[negative_locations[negative_count:negative_count + num_negatives]] = data[negative_indices]
+                negative_count += num_negatives
 
-        data = torch.cat((torch.cat(positive_examples)[:half_batch_size],
-                           torch.cat(negative_examples)[:half_batch_size]))
-        labels = torch.cat((torch.ones(half_batch_size, dtype=self.label_dtype),
-                            torch.zeros(half_batch_size, dtype=self.label_dtype)))
-        perm = torch.randperm(batch_size)
-        return data[perm], labels[perm]
+        return output_data, output_labels
 
 
 class SmartBalancedBatchObjectGenerator(ObjectGenerator):
     def __init__(self, n, field_configs, relation_class, negative_to_positive=True, constraints=DEFAULT_CONSTRAINTS,
                  batch_size=1, object_dtype=torch.float, label_dtype=torch.long, relation_kwargs=None,
-                 max_recursion_depth=20):
+                 pin_memory=False, max_recursion_depth=20):
         super(SmartBalancedBatchObjectGenerator, self).__init__(
             n=n, field_configs=field_configs, relation_class=relation_class, constraints=constraints,
-            batch_size=batch_size, object_dtype=object_dtype, label_dtype=label_dtype, relation_kwargs=relation_kwargs)
+            batch_size=batch_size, object_dtype=object_dtype, label_dtype=label_dtype, relation_kwargs=relation_kwargs,
+            pin_memory=pin_memory)
         self.negative_to_positive = negative_to_positive
         self.max_recursion_depth = max_recursion_depth
 
@@ -162,7 +251,7 @@ class SmartBalancedBatchObjectGenerator(ObjectGenerator):
         if recursion_depth > self.max_recursion_depth:
             raise ValueError('Object generator max recursion depth exceeded...')
 
-        data, labels = super(SmartBalancedBatchObjectGenerator, self).__call__(batch_size)
+        data, labels = self._generate(batch_size, *self._allocate(batch_size, self.pin_memory))
         positive_count = int(labels.sum())
         half_batch_size = int(batch_size / 2)
         if positive_count == half_batch_size:
@@ -177,9 +266,10 @@ class SmartBalancedBatchObjectGenerator(ObjectGenerator):
             if recursion_depth > self.max_recursion_depth:
                 raise ValueError('Object generator max recursion depth exceeded...')
 
-            indices_to_resample = torch.nonzero(labels.bool() == self.negative_to_positive).squeeze()
-            num_to_resample = len(indices_to_resample)
-            resampled_data, resampled_labels = super(SmartBalancedBatchObjectGenerator, self).__call__(num_to_resample)
+            (indices_to_resample,) = torch.nonzero(labels.bool() == self.negative_to_positive, as_tuple=True)
+            num_to_resample = indices_to_resample.numel()
+            resampled_data, resampled_labels = self._generate(num_to_resample,
+                                                              *self._scratch_buffer(num_to_resample))
 
             data[indices_to_resample] = resampled_data
             labels[indices_to_resample] = resampled_labels
@@ -191,12 +281,11 @@ class SmartBalancedBatchObjectGenerator(ObjectGenerator):
             more_positive_examples = positive_count > half_batch_size
 
         # At this point, we're guaranteed to be able to modify in the direction the balancer supports
-        indices_to_modify = torch.nonzero(labels.bool() == (not self.negative_to_positive)).squeeze()
+        (indices_to_modify,) = torch.nonzero(labels.bool() == (not self.negative_to_positive), as_tuple=True)
         num_samples_to_modify = abs(positive_count - half_batch_size)
         target_indices = indices_to_modify[torch.randperm(indices_to_modify.shape[0])[:num_samples_to_modify]]
-        for index in target_indices:
-            data[index] = self.relation.balance(data[index], not self.negative_to_positive)
-            labels[index] = self.negative_to_positive
+        data[target_indices] = self.relation.balance_batch(data[target_indices], not self.negative_to_positive)
+        labels[target_indices] = self.negative_to_positive
 
         return data, labels
 
@@ -208,11 +297,43 @@ class ObjectGeneratorDataset(torch.utils.data.Dataset):
         self.epoch_size = epoch_size
         self.objects = None
         self.labels = None
+        self.shared_memory = False
         self.regenerate()
 
     def regenerate(self):
         if self.epoch_size > 0:
+            previous_objects, previous_labels = self.objects, self.labels
             self.objects, self.labels = self.object_generator(self.epoch_size)
+            self.convert_objects()
+
+            if self.shared_memory:
+                if previous_objects is not None and previous_objects.shape == self.objects.shape and \
+                        previous_labels.shape == self.labels.shape:
+                    # workers (including persistent ones) hold on to the shared tensors, so overwrite them in place
+                    self.objects = previous_objects.copy_(self.objects)
+                    self.labels = previous_labels.copy_(self.labels)
+
+                else:
+                    self.objects.share_memory_()
+                    self.labels.share_memory_()
+
+    def convert_objects(self):
+        pass
+
+    def share_memory_(self):
+        """
+        Keep the objects and labels in shared memory, so dataloader workers access them in place rather than each
+        receiving its own copy. Regenerating overwrites the shared tensors in place, so existing workers see the new
+        data, as long as the shape of the data does not change (e.g. by changing epoch_size). Otherwise, the data is
+        moved to new shared tensors, which only workers started after the regeneration see.
+        :return: self
+        """
+        self.shared_memory = True
+        if self.objects is not None:
+            self.objects.share_memory_()
+            self.labels.share_memory_()
+
+        return self
 
     def __getitem__(self, item):
         return self.objects[item], self.labels[item]
@@ -222,14 +343,32 @@ class ObjectGeneratorDataset(torch.utils.data.Dataset):
 
 
 class SpatialObjectGeneratorDataset(ObjectGeneratorDataset):
-    def __init__(self, object_generator, epoch_size, position_fields=DEFAULT_POSITION_FIELDS):
+    def __init__(self, object_generator, epoch_size, position_fields=DEFAULT_POSITION_FIELDS, spatial_dtype=None):
+        """
+        :param spatial_dtype: Which dtype to store the spatial objects in, defaulting to that of the generated objects.
+        As they only hold small integer positions and one-hot values, torch.float16 stores them exactly in half the
+        memory. Examples are returned in the dtype of the generated objects either way.
+        """
         self.position_fields = position_fields
         self.position_field_generators = [object_generator.field_generators[p] for p in self.position_fields]
+        self.spatial_dtype = spatial_dtype
+        self.output_dtype = None
         super(SpatialObjectGeneratorDataset, self).__init__(object_generator=object_generator, epoch_size=epoch_size)
 
-    def regenerate(self):
-        super(SpatialObjectGeneratorDataset, self).regenerate()
-        self.convert_objects()
+    @classmethod
+    def from_dataset(cls, dataset, position_fields=DEFAULT_POSITION_FIELDS, spatial_dtype=None):
+        """
+        Create a spatial dataset from the objects of an existing dataset, rather than generating new objects
+        :param dataset: An ObjectGeneratorDataset whose objects and labels to convert
+        :return: A SpatialObjectGeneratorDataset with the same examples as dataset
+        """
+        spatial_dataset = cls(dataset.object_generator, 0, position_fields, spatial_dtype)
+        spatial_dataset.epoch_size = dataset.epoch_size
+        # convert_objects creates a new tensor for the objects, so only the labels need copying
+        spatial_dataset.objects = dataset.objects
+        spatial_dataset.labels = dataset.labels.clone()
+        spatial_dataset.convert_objects()
+        return spatial_dataset
 
     def convert_objects(self):
         if self.objects is None or len(self.objects.shape) == 2 or self.objects.shape[0] == 0:
@@ -239,53 +378,58 @@ class SpatialObjectGeneratorDataset(ObjectGeneratorDataset):
 
         position_shape = [field.max_coord - field.min_coord for field in self.position_field_generators]
         spatial_shape = (D, O, *position_shape)
-        spatial_objects = torch.zeros(spatial_shape, dtype=self.objects.dtype)
-        for ex_index in range(D):
-            # TODO: if this work, could probably flatten it again, but I don't think it's worth optimizing
-            position_lists = [self.objects[ex_index, :, self.object_generator.field_slices[name]].long()
-                              for name in self.position_fields]
-
-            if len(position_lists) == 1:
-                spatial_objects[ex_index, :, position_lists[0]] = self.objects[ex_index].transpose(0, 1).unsqueeze(-1)
-
-            elif len(position_lists) == 2:
-                spatial_objects[ex_index, :, position_lists[0],
-                position_lists[1]] = self.objects[ex_index].transpose(0, 1).unsqueeze(-1)
-
-            elif len(position_lists) == 3:
-                spatial_objects[ex_index, :, position_lists[0],
-                position_lists[1], position_lists[2]] = self.objects[ex_index].transpose(0, 1).unsqueeze(-1)
-
-            # for obj_index in range(N):
-            #     object_position = [self.objects[ex_index, obj_index, self.object_generator.field_slices[name]]
-            #                        for name in self.position_fields]
-            #     if len(object_position) == 1:
-            #         spatial_objects[ex_index, object_position[0]] = self.objects[ex_index, obj_index]
-            #
-            #     elif len(object_position) == 2:
-            #         spatial_objects[ex_index, object_position[0],
-            #                         object_position[1]] = self.objects[ex_index, obj_index]
-            #
-            #     elif len(object_position) == 3:
-            #         spatial_objects[ex_index, object_position[0],
-            #                         object_position[1], object_position[2]] = self.objects[ex_index, obj_index]
-            #
-            #     else:
-            #         raise ValueError(f'Currently only accounting for up to 3D positions, got {len(object_position)} dimensions: {object_position}')
+        self.output_dtype = self.objects.dtype
+        spatial_dtype = self.spatial_dtype if self.spatial_dtype is not None else self.objects.dtype
+        spatial_objects = torch.zeros(spatial_shape, dtype=spatial_dtype)
+
+        # place every object of every example at once: indexing with (D, N) example and position indices around the
+        # object dimension selects a (D, N, O) tensor, which matches the shape of the objects
+        example_indices = torch.arange(D).unsqueeze(1).expand(D, N)
+        position_indices = [self.objects[:, :, self.object_generator.field_slices[name]].squeeze(-1).long()
+                            for name in self.position_fields]
+        spatial_objects[(example_indices, slice(None), *position_indices)] = self.objects.to(spatial_dtype)
+
         self.objects = spatial_objects
 
+    def __getitem__(self, item):
+        objects, labels = super(SpatialObjectGeneratorDataset, self).__getitem__(item)
+        if self.output_dtype is not None:
+            objects = objects.to(self.output_dtype)
+
+        return objects, labels
+
 
 class ObjectGeneratorIterableDataset(torch.utils.data.IterableDataset):
-    def __init__(self, object_generator, epoch_size):
+    def __init__(self, object_generator, epoch_size, batch_size=None):
+        """
+        :param object_generator: The object generator to generate each epoch with
+        :param epoch_size: How many sets of objects to generate per epoch
+        :param batch_size: If provided, yield entire batches of this size, rather than single sets of objects. A
+        dataloader over this dataset should then be created with batch_size=None, to pass the batches through as-is.
+        """
         super(ObjectGeneratorIterableDataset, self).__init__()
         self.object_generator = object_generator
         self.epoch_size = epoch_size
+        self.batch_size = batch_size
 
     def __iter__(self):
-        objects, labels = self.object_generator(self.epoch_size)
+        epoch_size = self.epoch_size
+        worker_info = torch.utils.data.get_worker_info()
+        # Generation is independent and random, so each dataloader worker can simply generate its share of the epoch
+        if worker_info is not None:
+            epoch_size = self.epoch_size // worker_info.num_workers
+            if worker_info.id < self.epoch_size % worker_info.num_workers:
+                epoch_size += 1
+
+        objects, labels = self.object_generator(epoch_size)
 
         def generator():
-            for i in range(self.epoch_size):
-                yield objects[i], labels[i]
+            if self.batch_size is None:
+                for i in range(epoch_size):
+                    yield objects[i], labels[i]
+
+            else:
+                for start in range(0, epoch_size, self.batch_size):
+                    yield objects[start:start + self.batch_size], labels[start:start + self.batch_size]
 
         return generator()
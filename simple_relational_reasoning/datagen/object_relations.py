@@ -3,6 +3,82 @@ import random
 import torch
 
 
+# Batched kernels shared by the relations, compiled with TorchScript to keep the interpreter off the hot path.
+# All of them take a batch of (B, N, ...) sets of objects and return a (B,) boolean tensor.
+
+@torch.jit.script
+def any_pair_at_l1_distance_one(positions):
+    """
+    :param positions: A (B, N, D) tensor of object positions
+    :return: Whether any two objects in each set are at an L1 distance of one from each other
+    """
+    l1_distances = (positions.unsqueeze(1) - positions.unsqueeze(2)).abs().sum(-1)
+    return l1_distances.eq(1).flatten(1).any(1)
+
+
+@torch.jit.script
+def any_sorted_neighbors_at_distance_one(values):
+    """
+    On a single axis, two values are at a distance of one only if they are also neighbors once sorted
+    :param values: A (B, N) tensor of object positions along a single axis
+    :return: Whether any two objects in each set are at a distance of one from each other
+    """
+    sorted_values = values.sort(1)[0]
+    return (sorted_values[:, 1:] - sorted_values[:, :-1]).eq(1).any(1)
+
+
+@torch.jit.script
+def any_identical_pair(values):
+    """
+    :param values: A (B, N, D) tensor of object values to compare
+    :return: Whether any two different objects in each set have identical values
+    """
+    matches = (values.unsqueeze(1) == values.unsqueeze(2)).all(-1)
+    # each object always matches itself, so any set with more than N matches has two identical objects
+    return matches.flatten(1).sum(1) > values.shape[1]
+
+
+@torch.jit.script
+def any_above_all_below(y_positions, above_mask, below_mask):
+    """
+    :param y_positions: A (B, N) tensor of object heights
+    :param above_mask: A (B, N) boolean tensor of which objects should be above
+    :param below_mask: A (B, N) boolean tensor of which objects should be below
+    :return: Whether any object in the above mask in each set is at least as high as all objects in the below mask
+    """
+    # some object is at least as high as all the below objects exactly when the highest one is
+    y_positions = y_positions.to(torch.float)
+    lowest = torch.full_like(y_positions, float('-inf'))
+    max_above_y = torch.where(above_mask, y_positions, lowest).max(1)[0]
+    max_below_y = torch.where(below_mask, y_positions, lowest).max(1)[0]
+    return above_mask.any(1) & (max_above_y >= max_below_y)
+
+
+@torch.jit.script
+def any_between_triplet(line_positions, offset_positions, outside_mask, inside_mask, max_coord: int):
+    """
+    :param line_positions: A (B, N) tensor of object positions along the axis the objects of a triplet share
+    :param offset_positions: A (B, N) tensor of object positions along the axis the triplet is consecutive on
+    :param outside_mask: A (B, N) boolean tensor of which objects can be on the outside of a triplet
+    :param inside_mask: A (B, N) boolean tensor of which objects can be on the inside of a triplet
+    :param max_coord: A bound on the offset positions, to sort the objects by line and then by offset with one key
+    :return: Whether any three objects in each set are at consecutive positions on the same line, with an inside
+    object between two outside ones
+    """
+    # once sorted, the objects of such a triplet are neighbors
+    order = (line_positions * max_coord + offset_positions).sort(1)[1]
+    line_positions = line_positions.gather(1, order)
+    offset_positions = offset_positions.gather(1, order)
+    outside_mask = outside_mask.gather(1, order)
+    inside_mask = inside_mask.gather(1, order)
+
+    consecutive = (line_positions[:, 1:] == line_positions[:, :-1]) & \
+        (offset_positions[:, 1:] - offset_positions[:, :-1]).eq(1)
+    triplets = consecutive[:, :-1] & consecutive[:, 1:] & \
+        outside_mask[:, :-2] & inside_mask[:, 1:-1] & outside_mask[:, 2:]
+    return triplets.any(1)
+
+
 class ObjectRelation:
     def __init__(self, field_slices, field_generators, position_field_names=('x', 'y')):
         """
@@ -16,6 +92,29 @@ class ObjectRelation:
         self.position_field_names = position_field_names
         self.position_field_slices = [self.field_slices[name] for name in self.position_field_names]
         self.position_field_generators = [self.field_generators[name] for name in self.position_field_names]
+        self.position_columns = self._field_columns(self.position_field_slices)
+
+        # constant labels, to avoid allocating a new tensor whenever a relation returns one
+        self._true = torch.tensor(True)
+        self._false = torch.tensor(False)
+
+    @staticmethod
+    def _field_columns(field_slices):
+        """
+        Precompute how to gather several fields of the vector objects at once
+        :param field_slices: A list of slices of fields in the vector objects
+        :return: A single slice covering all of them if they are adjacent and in order, or a tensor of the indices
+        of their columns otherwise, either of which can index the last dimension of the objects
+        """
+        for current_slice, next_slice in zip(field_slices[:-1], field_slices[1:]):
+            if current_slice.stop != next_slice.start:
+                return torch.tensor([column for field_slice in field_slices
+                                     for column in range(field_slice.start, field_slice.stop)], dtype=torch.long)
+
+        return slice(field_slices[0].start, field_slices[-1].stop)
+
+    def _positions(self, objects):
+        return objects[..., self.position_columns]
 
     @abstractmethod
     def evaluate(self, objects):
@@ -27,6 +126,16 @@ class ObjectRelation:
         """
         pass
 
+    def evaluate_batch(self, object_batch):
+        """
+        Evaluate the relation on a batch of sets of objects, by default evaluating each set in turn. Relations that
+        can evaluate the entire batch with vectorized operations should override this.
+        :param object_batch: A tensor of shape (B, N, F) of sets of objects
+        :return: A boolean tensor of shape (B,), with the label of each set
+        """
+        return torch.tensor([bool(self.evaluate(object_batch[i])) for i in range(object_batch.shape[0])],
+                            dtype=torch.bool)
+
     @abstractmethod
     def balance(self, objects, current_label):
         """
@@ -37,12 +146,35 @@ class ObjectRelation:
         """
         pass
 
-    def _object_in_position(self, objects, position):
-        object_positions = torch.cat([objects[:, field_slice] for field_slice in self.position_field_slices],
-                                     dim=1).to(torch.float).unsqueeze(0)
+    def balance_batch(self, object_batch, current_label):
+        """
+        Balance a batch of sets of objects, by default balancing each set in turn. Relations that can balance
+        the entire batch with vectorized operations should override this.
+        :param object_batch: A tensor of shape (K, N, F) of sets of objects to balance
+        :return: The sets of objects, with the opposite label
+        """
+        for i in range(object_batch.shape[0]):
+            object_batch[i] = self.balance(object_batch[i], current_label)
+
+        return object_batch
+
+    @staticmethod
+    def _random_index_pairs(batch_size, n):
+        """
+        Draw a pair of distinct object indices for each set of objects in a batch
+        """
+        first_indices = torch.randint(n, (batch_size,))
+        second_indices = (first_indices + torch.randint(1, n, (batch_size,))) % n
+        return first_indices, second_indices
 
-        matching_indices = torch.nonzero((object_positions == position).all(dim=1)).squeeze()
-        return len(matching_indices) > 0, matching_indices
+    @staticmethod
+    def _shift_by_one(values, min_coord, max_coord):
+        """
+        Shift each value by one in a random direction, or in the only valid direction at the edges of the grid
+        """
+        shifted_values = values + (torch.randint(2, values.shape) * 2 - 1).to(values.dtype)
+        shifted_values = torch.where(values == min_coord, values + 1, shifted_values)
+        return torch.where(values == max_coord - 1, values - 1, shifted_values)
 
 
 class OneDAdjacentRelation(ObjectRelation):
@@ -53,15 +185,17 @@ class OneDAdjacentRelation(ObjectRelation):
         self.relevant_field_generator = self.field_generators[self.relevant_field_name]
 
     def evaluate(self, objects):
-        positions = objects[:, self.relevant_field_slice]
-        l1_distances = torch.cdist(positions, positions, 1)
-        return torch.any(torch.isclose(l1_distances, torch.tensor([1.0])))
+        positions = objects[:, self.relevant_field_slice].flatten().sort()[0]
+        return (positions[1:] - positions[:-1]).eq(1).any()
+
+    def evaluate_batch(self, object_batch):
+        return any_sorted_neighbors_at_distance_one(object_batch[:, :, self.relevant_field_slice].squeeze(-1))
 
     def balance(self, objects, current_label):
         if current_label != 0:
             raise ValueError('Can only balance negative cases to positive ones for the time being')
 
-        index_to_modify, index_to_set_next_to = torch.randperm(objects.shape[0])[:2]
+        index_to_modify, index_to_set_next_to = random.sample(range(objects.shape[0]), 2)
         # set x and y to be the same, then modify one
         objects[index_to_modify, self.relevant_field_slice] = objects[index_to_set_next_to, self.relevant_field_slice]
 
@@ -74,26 +208,40 @@ class OneDAdjacentRelation(ObjectRelation):
 
         # if not, shift in either direction
         else:
-            objects[index_to_modify, self.relevant_field_slice] += torch.sign(torch.rand(tuple()) - 0.5)
+            objects[index_to_modify, self.relevant_field_slice] += random.choice((-1, 1))
 
         return objects
 
+    def balance_batch(self, object_batch, current_label):
+        if current_label != 0:
+            raise ValueError('Can only balance negative cases to positive ones for the time being')
+
+        rows = torch.arange(object_batch.shape[0])
+        indices_to_modify, indices_to_set_next_to = self._random_index_pairs(*object_batch.shape[:2])
+        positions = object_batch[rows, indices_to_set_next_to, self.relevant_field_slice]
+        object_batch[rows, indices_to_modify, self.relevant_field_slice] = self._shift_by_one(
+            positions, self.relevant_field_generator.min_coord, self.relevant_field_generator.max_coord)
+
+        return object_batch
+
 
 class MultipleDAdjacentRelation(ObjectRelation):
     def __init__(self, field_slices, field_generators, position_field_names=('x', 'y')):
         super(MultipleDAdjacentRelation, self).__init__(field_slices, field_generators, position_field_names)
 
     def evaluate(self, objects):
-        positions = torch.cat([objects[:, field_slice] for field_slice in self.position_field_slices],
-                              dim=1).to(torch.float).unsqueeze(0)
-        l1_distances = torch.cdist(positions, positions, 1)
-        return torch.any(torch.isclose(l1_distances, torch.tensor([1.0])))
+        positions = self._positions(objects)
+        l1_distances = (positions.unsqueeze(0) - positions.unsqueeze(1)).abs().sum(-1)
+        return l1_distances.eq(1).any()
+
+    def evaluate_batch(self, object_batch):
+        return any_pair_at_l1_distance_one(self._positions(object_batch))
 
     def balance(self, objects, current_label):
         if current_label != 0:
             raise ValueError('Can only balance negative cases to positive ones for the time being')
 
-        index_to_modify, index_to_set_next_to = torch.randperm(objects.shape[0])[:2]
+        index_to_modify, index_to_set_next_to = random.sample(range(objects.shape[0]), 2)
         # set x and y to be the same, then modify one
         for field_slice in self.position_field_slices:
             objects[index_to_modify, field_slice] = objects[index_to_set_next_to, field_slice]
@@ -111,15 +259,39 @@ class MultipleDAdjacentRelation(ObjectRelation):
 
         # if not, shift in either direction
         else:
-            objects[index_to_modify, slice_to_modify] += torch.sign(torch.rand(tuple()) - 0.5)
+            objects[index_to_modify, slice_to_modify] += random.choice((-1, 1))
 
         return objects
 
+    def balance_batch(self, object_batch, current_label):
+        if current_label != 0:
+            raise ValueError('Can only balance negative cases to positive ones for the time being')
+
+        rows = torch.arange(object_batch.shape[0])
+        indices_to_modify, indices_to_set_next_to = self._random_index_pairs(*object_batch.shape[:2])
+
+        # take the positions of the objects to set next to, then shift each along one randomly chosen dimension
+        positions = torch.cat([object_batch[rows, indices_to_set_next_to, field_slice]
+                               for field_slice in self.position_field_slices], dim=1)
+        dims_to_modify = torch.randint(len(self.position_field_slices), (object_batch.shape[0],))
+        min_coords = torch.tensor([gen.min_coord for gen in self.position_field_generators])[dims_to_modify]
+        max_coords = torch.tensor([gen.max_coord for gen in self.position_field_generators])[dims_to_modify]
+        positions[rows, dims_to_modify] = self._shift_by_one(positions[rows, dims_to_modify], min_coords, max_coords)
+
+        for dim, field_slice in enumerate(self.position_field_slices):
+            object_batch[rows, indices_to_modify, field_slice] = positions[:, dim:dim + 1]
+
+        return object_batch
+
 
 class ColorAboveColorRelation(ObjectRelation):
     def __init__(self, field_slices, field_generators, color_field_name='color',
                  above_color_index=0, below_color_index=1, dtype=torch.float, position_field_names=('x', 'y'),
-                 stuck_count_to_perturb_x=10):
+                 stuck_count_to_perturb_x=None):
+        """
+        :param stuck_count_to_perturb_x: Deprecated and ignored. Balancing now moves objects to other columns exactly
+        when their own column has no free position high enough, rather than after a number of failed attempts.
+        """
         super(ColorAboveColorRelation, self).__init__(field_slices, field_generators, position_field_names)
         self.x_field_name = position_field_names[0]
         self.x_field_slice = self.field_slices[self.x_field_name]
@@ -138,69 +310,122 @@ class ColorAboveColorRelation(ObjectRelation):
         self.above_color_index = above_color_index
         self.above_color_tensor = torch.zeros(self.color_field_gen.n_types, dtype=self.dtype)
         self.above_color_tensor[self.above_color_index] = 1
+        # colors are one-hot, so an object is of a color exactly when that color's column is set
+        self.above_color_column = self.color_field_slice.start + self.above_color_index
 
         self.below_color_index = below_color_index
         self.below_color_tensor = torch.zeros(self.color_field_gen.n_types, dtype=self.dtype)
         self.below_color_tensor[self.below_color_index] = 1
-
-        self.stuck_count_to_perturb_x = stuck_count_to_perturb_x
+        self.below_color_column = self.color_field_slice.start + self.below_color_index
 
     def evaluate(self, objects):
-        colors = objects[:, self.color_field_slice]
-        above_color_y_positions = objects[colors.eq(self.above_color_tensor).all(dim=1), self.y_field_slice]
-        below_color_y_positions = objects[colors.eq(self.below_color_tensor).all(dim=1), self.y_field_slice]
+        above_color_y_positions = objects[objects[:, self.above_color_column] == 1, self.y_field_slice]
+        below_color_y_positions = objects[objects[:, self.below_color_column] == 1, self.y_field_slice]
 
         if len(above_color_y_positions) == 0:
-            return torch.tensor(False)
+            return self._false
 
         if len(below_color_y_positions) == 0:
-            return torch.tensor(True)
+            return self._true
 
-        return (above_color_y_positions.view(-1, 1) >= below_color_y_positions.view(1, -1)).all(dim=1).any()
+        # some object of the above color is at least as high as all objects of the below color iff the highest is
+        return above_color_y_positions.max() >= below_color_y_positions.max()
+
+    def evaluate_batch(self, object_batch):
+        above_color_mask = object_batch[:, :, self.above_color_column] == 1
+        below_color_mask = object_batch[:, :, self.below_color_column] == 1
+        y_positions = object_batch[:, :, self.y_field_slice].squeeze(-1)
+        return any_above_all_below(y_positions, above_color_mask, below_color_mask)
+
+    def _sample_free_positions(self, x_positions, y_positions, current_x_positions, max_below_color_positions):
+        """
+        Sample a free grid position for each set of objects, at least as high as all objects of the below color,
+        preferring positions in the column of the object being moved, and only using other columns if it is full
+        :param x_positions: A (K, N) tensor of the x positions of the objects
+        :param y_positions: A (K, N) tensor of the y positions of the objects
+        :param current_x_positions: A (K,) tensor of the x position of the object to move in each set
+        :param max_below_color_positions: A (K,) tensor of the height of the highest below color object in each set
+        :return: Two (K,) tensors of the new x and y positions
+        """
+        K = x_positions.shape[0]
+        x_min, y_min = self.x_field_gen.min_coord, self.y_field_gen.min_coord
+        width, height = self.x_field_gen.max_coord - x_min, self.y_field_gen.max_coord - y_min
+
+        occupied = torch.zeros((K, width, height), dtype=torch.bool)
+        occupied[torch.arange(K).unsqueeze(1).expand_as(x_positions),
+                 (x_positions - x_min).long(), (y_positions - y_min).long()] = True
+
+        high_enough = torch.arange(height).view(1, 1, -1) >= (max_below_color_positions - y_min).long().view(-1, 1, 1)
+        free = ~occupied & high_enough
+        in_column = torch.arange(width).view(1, -1, 1) == (current_x_positions - x_min).long().view(-1, 1, 1)
+        free_in_column = free & in_column
+
+        candidates = torch.where(free_in_column.flatten(1).any(dim=1).view(-1, 1, 1), free_in_column, free).flatten(1)
+        if not candidates.any(dim=1).all():
+            raise ValueError('No free position above all objects of the below color to move an object to')
+
+        cells = torch.multinomial(candidates.to(torch.float), 1).squeeze(1)
+        return cells // height + x_min, cells % height + y_min
 
     def balance(self, objects, current_label):
         if current_label != 0:
             raise ValueError('Can only balance negative cases to positive ones for the time being')
 
-        colors = objects[:, self.color_field_slice]
-        above_color_y_positions = objects[colors.eq(self.above_color_tensor).all(dim=1), self.y_field_slice]
+        above_color_mask = objects[:, self.above_color_column] == 1
 
         # If no objects in the above color exist, create one
-        if len(above_color_y_positions) == 0:
+        if not above_color_mask.any():
             index_to_modify = random.randint(0, objects.shape[0] - 1)
             objects[index_to_modify, self.color_field_slice] = self.above_color_tensor
-            colors[index_to_modify, :] = self.above_color_tensor
+            above_color_mask[index_to_modify] = True
 
-        below_color_y_positions = objects[colors.eq(self.below_color_tensor).all(dim=1), self.y_field_slice]
-
-        if below_color_y_positions.shape[0] == 0:
-            max_below_color_position = self.y_field_gen.min_coord
-        else:
-            max_below_color_position = int(below_color_y_positions.max())
+        below_color_mask = objects[:, self.below_color_column] == 1
 
-        above_object_indices = torch.nonzero(colors.eq(self.above_color_tensor).all(dim=1)).squeeze()
-        if len(above_object_indices.shape) == 0:
-            index_to_modify = int(above_object_indices)
+        if below_color_mask.any():
+            max_below_color_position = int(objects[below_color_mask, self.y_field_slice].max())
         else:
-            index_to_modify = above_object_indices[torch.randperm(above_object_indices.shape[0])[0]]
-
-        collision = True
-        stuck_count = 0
-        while collision:
-            stuck_count += 1
+            max_below_color_position = self.y_field_gen.min_coord
 
-            new_above_color_x_position = objects[index_to_modify, self.x_field_slice]
-            if stuck_count > self.stuck_count_to_perturb_x:
-                new_above_color_x_position = random.randint(self.x_field_gen.min_coord, self.x_field_gen.max_coord - 1)
+        index_to_modify = int(torch.multinomial(above_color_mask.to(torch.float), 1))
 
-            new_above_color_y_position = random.randint(max_below_color_position, self.y_field_gen.max_coord - 1)
-            tentative_new_position = torch.tensor([new_above_color_x_position, new_above_color_y_position])
-            collision, _ = self._object_in_position(objects, tentative_new_position)
+        new_x_positions, new_y_positions = self._sample_free_positions(
+            objects[:, self.x_field_slice].reshape(1, -1), objects[:, self.y_field_slice].reshape(1, -1),
+            objects[index_to_modify, self.x_field_slice], torch.tensor([max_below_color_position]))
+        new_above_color_x_position, new_above_color_y_position = int(new_x_positions), int(new_y_positions)
 
         objects[index_to_modify, self.x_field_slice] = new_above_color_x_position
         objects[index_to_modify, self.y_field_slice] = new_above_color_y_position
         return objects
 
+    def balance_batch(self, object_batch, current_label):
+        if current_label != 0:
+            raise ValueError('Can only balance negative cases to positive ones for the time being')
+
+        K, N, _ = object_batch.shape
+        rows = torch.arange(K)
+
+        # If no objects in the above color exist in a set, create one
+        no_above_color = ~(object_batch[:, :, self.above_color_column] == 1).any(dim=1)
+        if no_above_color.any():
+            object_batch[rows[no_above_color], torch.randint(N, (int(no_above_color.sum()),)),
+                         self.color_field_slice] = self.above_color_tensor
+
+        above_color_mask = object_batch[:, :, self.above_color_column] == 1
+        below_color_mask = object_batch[:, :, self.below_color_column] == 1
+        x_positions = object_batch[:, :, self.x_field_slice].squeeze(-1)
+        y_positions = object_batch[:, :, self.y_field_slice].squeeze(-1)
+
+        min_y = torch.full_like(y_positions, self.y_field_gen.min_coord)
+        max_below_color_positions = torch.where(below_color_mask, y_positions, min_y).max(dim=1).values
+        indices_to_modify = torch.multinomial(above_color_mask.to(torch.float), 1).squeeze(1)
+
+        new_x_positions, new_y_positions = self._sample_free_positions(
+            x_positions, y_positions, x_positions[rows, indices_to_modify], max_below_color_positions)
+
+        object_batch[rows, indices_to_modify, self.x_field_slice] = new_x_positions.unsqueeze(1).to(object_batch.dtype)
+        object_batch[rows, indices_to_modify, self.y_field_slice] = new_y_positions.unsqueeze(1).to(object_batch.dtype)
+        return object_batch
+
 
 class ObjectCountRelation(ObjectRelation):
     def __init__(self, field_slices, field_generators, first_field_name='color', first_field_index=0,
@@ -214,6 +439,8 @@ class ObjectCountRelation(ObjectRelation):
         self.first_object_tensor = torch.zeros(self.first_field_gen.n_types, dtype=self.dtype)
         self.first_field_index = first_field_index
         self.first_object_tensor[self.first_field_index] = 1
+        # fields are one-hot, so an object is of a type exactly when that type's column is set
+        self.first_object_column = self.first_field_slice.start + self.first_field_index
 
         self.second_field_name = second_field_name
         self.second_field_slice = self.field_slices[self.second_field_name]
@@ -221,35 +448,38 @@ class ObjectCountRelation(ObjectRelation):
         self.second_object_tensor = torch.zeros(self.second_field_gen.n_types, dtype=self.dtype)
         self.second_field_index = second_field_index
         self.second_object_tensor[self.second_field_index] = 1
+        self.second_object_column = self.second_field_slice.start + self.second_field_index
+        self.second_field_other_columns = torch.tensor([self.second_field_slice.start + c
+                                                        for c in range(self.second_field_gen.n_types)
+                                                        if c != self.second_field_index], dtype=torch.long)
 
     def evaluate(self, objects):
-        first_objects = objects[:, self.first_field_slice]
-        second_objects = objects[:, self.second_field_slice]
-        first_object_count = first_objects.eq(self.first_object_tensor).all(dim=1).sum()
-        second_object_count = second_objects.eq(self.second_object_tensor).all(dim=1).sum()
+        first_object_count = (objects[:, self.first_object_column] == 1).sum()
+        second_object_count = (objects[:, self.second_object_column] == 1).sum()
+        return first_object_count > second_object_count
+
+    def evaluate_batch(self, object_batch):
+        first_object_count = (object_batch[:, :, self.first_object_column] == 1).sum(dim=1)
+        second_object_count = (object_batch[:, :, self.second_object_column] == 1).sum(dim=1)
         return first_object_count > second_object_count
 
     def balance(self, objects, current_label):
         if current_label != 0:
             raise ValueError('Can only balance negative cases to positive ones for the time being')
 
-        first_objects = objects[:, self.first_field_slice]
-        second_objects = objects[:, self.second_field_slice]
-        first_object_count = first_objects.eq(self.first_object_tensor).all(dim=1).sum()
-        second_object_count = second_objects.eq(self.second_object_tensor).all(dim=1).sum()
+        first_object_count = (objects[:, self.first_object_column] == 1).sum()
+        second_object_count = (objects[:, self.second_object_column] == 1).sum()
 
         min_objects_to_modify = second_object_count - first_object_count + 1
         if second_object_count == objects.shape[0]:  # min_objects_to_modify > objects.shape[0]:
-            second_object_indices = torch.nonzero(second_objects.eq(self.second_object_tensor).all(dim=1)).squeeze()
-            num_second_objects_to_modify = random.randint(1, len(second_object_indices) - 1)
-            second_object_indices_to_modify = second_object_indices[torch.randperm(len(second_object_indices))[:num_second_objects_to_modify]]
+            # all objects are of the second type, so any of them can be modified
+            num_second_objects_to_modify = random.randint(1, objects.shape[0] - 1)
+            second_object_indices_to_modify = random.sample(range(objects.shape[0]), num_second_objects_to_modify)
 
-            new_assignment_options = list(range(self.second_field_gen.n_types))
-            new_assignment_options.remove(self.second_field_index)
-            new_assignments = [self.second_field_slice.start + c
-                               for c in random.choices(new_assignment_options, k=num_second_objects_to_modify)]
+            new_assignments = self.second_field_other_columns[
+                torch.randint(len(self.second_field_other_columns), (num_second_objects_to_modify,))]
 
-            objects[second_object_indices_to_modify, self.second_field_slice.start + self.second_field_index] = 0
+            objects[second_object_indices_to_modify, self.second_object_column] = 0
             objects[second_object_indices_to_modify, new_assignments] = 1
             min_objects_to_modify -= num_second_objects_to_modify
 
@@ -259,15 +489,62 @@ class ObjectCountRelation(ObjectRelation):
         max_objects_to_modify = objects.shape[0] - first_object_count
         num_objects_to_modify = random.randint(min_objects_to_modify, max_objects_to_modify)
 
-        valid_indices_to_modify = torch.nonzero(~ (first_objects.eq(self.first_object_tensor).all(dim=1))).squeeze()
-        if len(valid_indices_to_modify.shape) == 0:
-            objects[valid_indices_to_modify, self.first_field_slice] = self.first_object_tensor
-        else:
-            indices_to_modify = valid_indices_to_modify[torch.randperm(valid_indices_to_modify.shape[0])][:num_objects_to_modify]
-            objects[indices_to_modify, self.first_field_slice] = self.first_object_tensor
+        # sample without replacement among the objects not already of the first type
+        valid_mask = objects[:, self.first_object_column] != 1
+        indices_to_modify = torch.multinomial(valid_mask.to(torch.float), int(num_objects_to_modify))
+        objects[indices_to_modify, self.first_field_slice] = self.first_object_tensor
 
         return objects
 
+    @staticmethod
+    def _random_subset_masks(candidate_mask, subset_sizes):
+        """
+        Pick a uniformly random subset of the candidate objects of each set, of the given size
+        :param candidate_mask: A (K, N) boolean tensor of which objects can be picked
+        :param subset_sizes: A (K,) tensor of how many objects to pick from each set
+        :return: A (K, N) boolean tensor of the picked objects
+        """
+        noise = torch.where(candidate_mask, torch.rand(candidate_mask.shape), torch.full(candidate_mask.shape, 2.0))
+        ranks = noise.argsort(dim=1).argsort(dim=1)
+        return (ranks < subset_sizes.unsqueeze(1)) & candidate_mask
+
+    def balance_batch(self, object_batch, current_label):
+        if current_label != 0:
+            raise ValueError('Can only balance negative cases to positive ones for the time being')
+
+        K, N, _ = object_batch.shape
+        first_objects = object_batch[:, :, self.first_field_slice]
+        second_objects = object_batch[:, :, self.second_field_slice]
+        first_object_mask = object_batch[:, :, self.first_object_column] == 1
+        second_object_mask = object_batch[:, :, self.second_object_column] == 1
+        first_object_count = first_object_mask.sum(dim=1)
+        second_object_count = second_object_mask.sum(dim=1)
+
+        min_objects_to_modify = second_object_count - first_object_count + 1
+
+        # In sets where all objects are of the second type, change some of them to a different type
+        all_second_objects = second_object_count == N
+        if all_second_objects.any():
+            num_second_objects_to_modify = torch.where(all_second_objects, torch.randint(1, N, (K,)),
+                                                       torch.zeros(K, dtype=torch.long))
+            second_objects_to_modify = self._random_subset_masks(second_object_mask, num_second_objects_to_modify)
+
+            n_types = self.second_field_gen.n_types
+            new_types = (self.second_field_index + torch.randint(1, n_types, (K, N))) % n_types
+            new_second_objects = torch.nn.functional.one_hot(new_types, n_types).to(object_batch.dtype)
+            second_objects[second_objects_to_modify] = new_second_objects[second_objects_to_modify]
+            min_objects_to_modify -= num_second_objects_to_modify
+
+        max_objects_to_modify = N - first_object_count
+        num_objects_to_modify = min_objects_to_modify + torch.floor(
+            torch.rand(K) * (max_objects_to_modify - min_objects_to_modify + 1)).to(torch.long)
+        num_objects_to_modify = torch.where(min_objects_to_modify > 0, num_objects_to_modify,
+                                            torch.zeros_like(num_objects_to_modify))
+
+        objects_to_modify = self._random_subset_masks(~first_object_mask, num_objects_to_modify)
+        first_objects[objects_to_modify] = self.first_object_tensor
+        return object_batch
+
 
 class IdenticalObjectsRelation(ObjectRelation):
     def __init__(self, field_slices, field_generators, field_names=('color', 'shape'), position_field_names=('x', 'y')):
@@ -275,28 +552,43 @@ class IdenticalObjectsRelation(ObjectRelation):
         self.property_field_names = field_names
         self.property_field_slices = [self.field_slices[name] for name in self.property_field_names]
         self.property_field_generators = [self.field_generators[name] for name in self.property_field_names]
+        self.property_columns = self._field_columns(self.property_field_slices)
 
-    def evaluate(self, objects):
-        object_properties = torch.cat([objects[:, field_slice] for field_slice in self.property_field_slices],
-                                      dim=1).to(torch.float).unsqueeze(0)
+    def _properties(self, objects):
+        return objects[..., self.property_columns]
 
-        for i in range(object_properties.shape[0] - 1):
-            if (object_properties[i + 1:] == object_properties[i]).all(dim=1).any():
-                return True
+    def evaluate(self, objects):
+        object_properties = self._properties(objects)
+        matches = (object_properties.unsqueeze(0) == object_properties.unsqueeze(1)).all(dim=-1)
+        matches.fill_diagonal_(False)
+        return matches.any()
 
-        return False
+    def evaluate_batch(self, object_batch):
+        return any_identical_pair(self._properties(object_batch))
 
     def balance(self, objects, current_label):
         if current_label != 0:
             raise ValueError('Can only balance negative cases to positive ones for the time being')
 
-        index_to_modify, index_to_copy_from = torch.randperm(objects.shape[0])[:2]
+        index_to_modify, index_to_copy_from = random.sample(range(objects.shape[0]), 2)
 
         for field_slice in self.property_field_slices:
             objects[index_to_modify, field_slice] = objects[index_to_copy_from, field_slice]
 
         return objects
 
+    def balance_batch(self, object_batch, current_label):
+        if current_label != 0:
+            raise ValueError('Can only balance negative cases to positive ones for the time being')
+
+        rows = torch.arange(object_batch.shape[0])
+        indices_to_modify, indices_to_copy_from = self._random_index_pairs(*object_batch.shape[:2])
+
+        for field_slice in self.property_field_slices:
+            object_batch[rows, indices_to_modify, field_slice] = object_batch[rows, indices_to_copy_from, field_slice]
+
+        return object_batch
+
 
 class BetweenRelation(ObjectRelation):
     def __init__(self, field_slices, field_generators, relevant_field_name='color', outside_field_index=0,
@@ -351,22 +643,35 @@ class BetweenRelation(ObjectRelation):
     def evaluate(self, objects):
         return self._find_between_relation(objects, 0) or self._find_between_relation(objects, 1)
 
+    def evaluate_batch(self, object_batch):
+        positions = self._positions(object_batch)
+        relevant_values = object_batch[:, :, self.relevant_field_slice]
+        outside_mask = (relevant_values == self.outside_object_tensor).all(-1)
+        inside_mask = (relevant_values == self.inside_object_tensor).all(-1)
+
+        result = None
+        for first_position_field in (0, 1):
+            field_result = any_between_triplet(positions[:, :, first_position_field],
+                                               positions[:, :, 1 - first_position_field], outside_mask, inside_mask,
+                                               self.position_field_generators[first_position_field].max_coord)
+            result = field_result if result is None else result | field_result
+
+        return result
+
     def balance(self, objects, current_label):
         if current_label != 0:
             raise ValueError('Can only balance negative cases to positive ones for the time being')
 
-        positions = torch.cat([objects[:, field_slice] for field_slice in self.position_field_slices],
-                              dim=1).to(torch.float)
+        positions = self._positions(objects)
 
         # pick an object to utilize as a starting for the between triplet
-        start_index = torch.randperm(objects.shape[0])[0]
+        start_index = random.randrange(objects.shape[0])
         start_position = positions[start_index]
 
         # pick an axis
         same_axis = round(random.random())
         change_axis = 1 - same_axis
 
-        direction = 0
         # pick a direction along the other axis
         if objects[start_index, self.position_field_slices[change_axis]] < self.position_field_generators[change_axis].min_coord + 2:
             direction = 1
@@ -374,9 +679,8 @@ class BetweenRelation(ObjectRelation):
         elif objects[start_index, self.position_field_slices[change_axis]] > self.position_field_generators[change_axis].max_coord - 3:
             direction = -1
 
-        # the else condition, here because if torch.rand ~= 0, torch.sign will return 0, and will cause a bug
-        while direction == 0:
-            direction = int(torch.sign(torch.rand(tuple()) - 0.5))
+        else:
+            direction = random.choice((-1, 1))
 
         between_positions = torch.stack([start_position] * 3)
         between_positions[1, change_axis] += direction
@@ -417,3 +721,51 @@ class BetweenRelation(ObjectRelation):
             objects[object_index, self.relevant_field_slice] = self.between_objects_tensor[i]
 
         return objects
+
+    def balance_batch(self, object_batch, current_label):
+        if current_label != 0:
+            raise ValueError('Can only balance negative cases to positive ones for the time being')
+
+        K, N = object_batch.shape[:2]
+        rows = torch.arange(K)
+        positions = self._positions(object_batch)
+
+        # pick an object to start each between triplet from, and an axis to place the triplet along
+        start_indices = torch.randint(N, (K,))
+        change_axes = torch.randint(2, (K,))
+        min_coords = torch.tensor([gen.min_coord for gen in self.position_field_generators])[change_axes]
+        max_coords = torch.tensor([gen.max_coord for gen in self.position_field_generators])[change_axes]
+
+        # pick a direction along that axis, which leaves room for the triplet on the grid
+        start_positions = positions[rows, start_indices]
+        start_coords = start_positions[rows, change_axes]
+        directions = torch.randint(2, (K,)) * 2 - 1
+        directions = torch.where(start_coords < min_coords + 2, torch.ones_like(directions), directions)
+        directions = torch.where(start_coords > max_coords - 3, -torch.ones_like(directions), directions)
+
+        between_positions = start_positions.unsqueeze(1).repeat(1, 3, 1)
+        between_positions[rows, 1, change_axes] += directions.to(between_positions.dtype)
+        between_positions[rows, 2, change_axes] += 2 * directions.to(between_positions.dtype)
+
+        # objects already in the new positions are reused, and the remaining positions get random other objects
+        match_masks = [(positions == between_positions[:, i].unsqueeze(1)).all(-1) for i in (1, 2)]
+        available = torch.ones((K, N), dtype=torch.bool)
+        available[rows, start_indices] = False
+        for match_mask in match_masks:
+            available &= ~match_mask
+
+        random_keys = torch.where(available, torch.rand((K, N)), torch.full((K, N), -1.0))
+        random_indices = random_keys.argsort(1, descending=True)
+        first_matched, second_matched = [match_mask.any(1) for match_mask in match_masks]
+        first_indices = torch.where(first_matched, match_masks[0].long().argmax(1), random_indices[:, 0])
+        second_indices = torch.where(second_matched, match_masks[1].long().argmax(1),
+                                     torch.where(first_matched, random_indices[:, 0], random_indices[:, 1]))
+
+        between_objects = self.between_objects_tensor.to(object_batch.dtype)
+        for i, object_indices in enumerate((start_indices, first_indices, second_indices)):
+            for p, field_slice in enumerate(self.position_field_slices):
+                object_batch[rows, object_indices, field_slice] = between_positions[:, i, p:p + 1]
+
+            object_batch[rows, object_indices, self.relevant_field_slice] = between_objects[i]
+
+        return object_batch
@@ -1,5 +1,6 @@
 from abc import abstractmethod
 from enum import Enum, auto
+import random
 
 import torch
 import pytorch_lightning as pl
@@ -9,6 +10,9 @@ from torch.utils.data import DataLoader
 from simple_relational_reasoning.datagen import ObjectGeneratorDataset
 
 
+DEFAULT_PREFETCH_FACTOR = 4
+
+
 class ObjectCombinationMethod(Enum):
     SUM = auto()
     MEAN = auto()
@@ -25,10 +29,18 @@ class ObjectCombinationMethod(Enum):
             return x.view(x.shape[0], -1)
 
 
+def seed_worker(worker_id):
+    """
+    Seed Python's random module, which the object relations use, differently in each dataloader worker.
+    torch already seeds each worker with a different seed, so derive the seed from it.
+    """
+    random.seed(torch.initial_seed() % 2 ** 32)
+
+
 class BaseObjectModel(pl.LightningModule):
     def __init__(self, object_generator, loss=F.cross_entropy, optimizer_class=torch.optim.Adam, lr=1e-4,
                  batch_size=32, train_epoch_size=1024, validation_epoch_size=1024, test_epoch_size=1024,
-                 regenerate_every_epoch=False,
+                 regenerate_every_epoch=False, num_workers=0,
                  dataset_class=ObjectGeneratorDataset,
                  train_dataset=None, validation_dataset=None, test_dataset=None,
                  train_log_prefix=None, validation_log_prefix=None, test_log_prefix=None):
@@ -47,6 +59,7 @@ class BaseObjectModel(pl.LightningModule):
         self.validation_epoch_size = validation_epoch_size
         self.test_epoch_size = test_epoch_size
         self.regenerate_every_epoch = regenerate_every_epoch
+        self.num_workers = num_workers
 
         if train_dataset is None:
             train_dataset = dataset_class(self.object_generator, self.train_epoch_size)
@@ -64,6 +77,8 @@ class BaseObjectModel(pl.LightningModule):
         self.validation_log_prefix = validation_log_prefix
         self.test_log_prefix = test_log_prefix
 
+        self._memcpy_stream = None
+
     @abstractmethod
     def embed(self, x):
         pass
@@ -100,16 +115,55 @@ class BaseObjectModel(pl.LightningModule):
     def test_step(self, batch, batch_idx):
         return self.training_step(batch, batch_idx)
 
+    def _create_dataloader(self, dataset):
+        # datasets that already yield entire batches (see ObjectGeneratorIterableDataset) are passed through as-is
+        batch_size = self.batch_size
+        if getattr(dataset, 'batch_size', None) is not None:
+            batch_size = None
+
+        # pinned batches allow the copy to the GPU to be asynchronous, see transfer_batch_to_device
+        dataloader_kwargs = dict(batch_size=batch_size, num_workers=self.num_workers,
+                                 pin_memory=self.device.type == 'cuda')
+        if self.num_workers > 0:
+            # avoid copying pregenerated datasets to each worker
+            if hasattr(dataset, 'share_memory_'):
+                dataset.share_memory_()
+
+            dataloader_kwargs.update(persistent_workers=True, prefetch_factor=DEFAULT_PREFETCH_FACTOR,
+                                     worker_init_fn=seed_worker)
+
+        return DataLoader(dataset, **dataloader_kwargs)
+
     def train_dataloader(self):
-        return DataLoader(self.train_dataset, batch_size=self.batch_size)
+        return self._create_dataloader(self.train_dataset)
 
     def val_dataloader(self):
         # TODO: why is this val_ while the other methods are validation_
         # TODO: this also seems to assume that the dataset is not an iterable one.
-        return DataLoader(self.validation_dataset, batch_size=self.batch_size)
+        return self._create_dataloader(self.validation_dataset)
 
     def test_dataloader(self):
-        return DataLoader(self.test_dataset, batch_size=self.batch_size)
+        return self._create_dataloader(self.test_dataset)
+
+    def transfer_batch_to_device(self, batch, device, *args, **kwargs):
+        device = torch.device(device)
+        if device.type != 'cuda':
+            return [x.to(device) for x in batch]
+
+        # copy on a separate stream, so the copy can overlap with the computation still queued for the previous batch
+        if self._memcpy_stream is None:
+            self._memcpy_stream = torch.cuda.Stream(device)
+
+        with torch.cuda.stream(self._memcpy_stream):
+            batch = [x.to(device, non_blocking=True) for x in batch]
+
+        current_stream = torch.cuda.current_stream(device)
+        current_stream.wait_stream(self._memcpy_stream)
+        # the batch was allocated on the copy stream, so make sure its memory isn't reused while still in use
+        for x in batch:
+            x.record_stream(current_stream)
+
+        return batch
 
     def _average_outputs(self, outputs, prefix, extra_prefix=None):
         avg_loss = torch.stack([x['loss'] for x in outputs]).mean()
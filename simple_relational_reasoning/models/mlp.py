@@ -10,13 +10,13 @@ class MLPModel(BaseObjectModel):
                  output_size=2, output_activation_class=None,
                  loss=F.cross_entropy, optimizer_class=torch.optim.Adam, lr=1e-4,
                  batch_size=32, train_epoch_size=1024, validation_epoch_size=1024, test_epoch_size=1024,
-                 regenerate_every_epoch=False,
+                 regenerate_every_epoch=False, num_workers=0,
                  train_dataset=None, validation_dataset=None, test_dataset=None,
                  train_log_prefix=None, validation_log_prefix=None, test_log_prefix=None):
         super(MLPModel, self).__init__(object_generator, loss=loss, optimizer_class=optimizer_class,
                                        lr=lr, batch_size=batch_size, train_epoch_size=train_epoch_size,
                                        validation_epoch_size=validation_epoch_size, test_epoch_size=test_epoch_size,
-                                       regenerate_every_epoch=regenerate_every_epoch,
+                                       regenerate_every_epoch=regenerate_every_epoch, num_workers=num_workers,
                                        train_dataset=train_dataset, validation_dataset=validation_dataset,
                                        test_dataset=test_dataset, train_log_prefix=train_log_prefix,
                                        validation_log_prefix=validation_log_prefix,
@@ -65,7 +65,7 @@ class CombinedObjectMLPModel(BaseObjectModel):
                  output_size=2, output_activation_class=None,
                  loss=F.cross_entropy, optimizer_class=torch.optim.Adam, lr=1e-4,
                  batch_size=32, train_epoch_size=1024, validation_epoch_size=1024, test_epoch_size=1024,
-                 regenerate_every_epoch=False,
+                 regenerate_every_epoch=False, num_workers=0,
                  train_dataset=None, validation_dataset=None, test_dataset=None,
                  train_log_prefix=None, validation_log_prefix=None, test_log_prefix=None):
         super(CombinedObjectMLPModel, self).__init__(object_generator, loss=loss, optimizer_class=optimizer_class,
@@ -73,6 +73,7 @@ class CombinedObjectMLPModel(BaseObjectModel):
                                                      validation_epoch_size=validation_epoch_size,
                                                      test_epoch_size=test_epoch_size,
                                                      regenerate_every_epoch=regenerate_every_epoch,
+                                                     num_workers=num_workers,
                                                      train_dataset=train_dataset, validation_dataset=validation_dataset,
                                                      test_dataset=test_dataset, train_log_prefix=train_log_prefix,
                                                      validation_log_prefix=validation_log_prefix,